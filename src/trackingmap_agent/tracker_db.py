@@ -4,25 +4,50 @@ This module manages a sqlite database for storing tracker information
 """
 
 import sqlite3
+import logging
 import os
+import time
 from datetime import datetime
+from zoneinfo import ZoneInfo
+
+LOG: logging.Logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 DB_PATH = "tracker_data.db"
+JOURNAL_MODE = "WAL"
+PAGE_SIZE = 8192        # bytes, only applied to new (empty) databases
+BATCH_SIZE = 64         # rows buffered before they are written
+FLUSH_INTERVAL = 1.0    # max. seconds a row stays in the buffer
+SCHEMA_VERSION = 1      # stored as PRAGMA user_version, 1: timestamps in epoch ms
+
+# Format and time zone of the timestamps written by former versions
+LEGACY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+LEGACY_TIME_ZONE = ZoneInfo("Europe/Berlin")
+
+INSERT_SQL = """
+    INSERT INTO tracker_data (
+        tracker_id, latitude, longitude, battery, timestamp,
+        gw_rssi, gw_name, gw_latitude, gw_longitude, gw_timestamp
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
-# --- Tracker info structure (for reference) ---
-tracker_info = {
-    "tracker_id": "",
-    "longitude": 0.0,
-    "latitude": 0.0,
-    "battery": 0,
-    "timestamp": "",
-    "gw-rssi": -70,
-    "gw-name": "",
-    "gw-longitude": 0.0,
-    "gw-latitude": 0.0,
-    "gw-timestamp": ""
-}
+# --- Tracker row layout, column order of INSERT_SQL ---
+FIELDNAMES = (
+    "tracker_id",
+    "latitude",
+    "longitude",
+    "battery",
+    "timestamp-ms",     # epoch milliseconds
+    "gw-rssi",
+    "gw-name",
+    "gw-latitude",
+    "gw-longitude",
+    "gw-timestamp"
+)
+
+# --- Insert buffer ---
+_buffer: list[tuple] = []
+_last_flush = time.monotonic()
 
 
 def init_db(db_path=DB_PATH):
@@ -30,7 +55,10 @@ def init_db(db_path=DB_PATH):
     Initialize the SQLite database.
 
     If the database file does not exist, it creates a new one and
-    defines the schema for the 'tracker_data' table.
+    defines the schema for the 'tracker_data' table. Databases of
+    former versions are migrated to SCHEMA_VERSION. The indexes used
+    by the viewer queries are created on every start, so existing
+    databases get them as well.
 
     Args:
         db_path (str): Path to the SQLite database file.
@@ -40,7 +68,22 @@ def init_db(db_path=DB_PATH):
     """
     try:
         db_exists = os.path.exists(db_path)
-        conn = sqlite3.connect(db_path)
+        # Autocommit mode, transactions are started explicitly when flushing
+        conn = sqlite3.connect(db_path, isolation_level=None,
+                               cached_statements=256, check_same_thread=False)
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            # Page size must be set before the first table and before WAL is enabled
+            conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
+        if db_path != ":memory:":
+            # WAL lets readers (e.g. the map view) run concurrently with the writer
+            conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        conn.executescript("""
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size=268435456;
+            PRAGMA busy_timeout=5000;
+        """)
         cursor = conn.cursor()
 
         if not db_exists:
@@ -52,7 +95,7 @@ def init_db(db_path=DB_PATH):
                     longitude REAL,
                     latitude REAL,
                     battery INTEGER,
-                    timestamp DATETIME,
+                    timestamp INTEGER,
                     gw_rssi INTEGER,
                     gw_name TEXT,
                     gw_longitude REAL,
@@ -77,42 +120,120 @@ def init_db(db_path=DB_PATH):
             """)
             conn.commit()
 
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Formatted local timestamps sort above integers, convert them to epoch ms
+            conn.create_function("local_time_to_epoch_ms", 1, local_time_to_epoch_ms, deterministic=True)
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                UPDATE tracker_data SET timestamp = local_time_to_epoch_ms(timestamp)
+                WHERE typeof(timestamp) = 'text'
+            """)
+            cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            cursor.execute("COMMIT")
+
+        # Indexes for the viewer queries (also for existing DBs)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_tracker_ts
+            ON tracker_data(tracker_id, timestamp DESC)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_tracker_data_timestamp
+            ON tracker_data(timestamp DESC)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_tracker_config_tracker_id
+            ON tracker_config(tracker_id)
+        """)
+        conn.commit()
+
         return conn  # Return connection for reuse
     except sqlite3.Error as e:
-        print(f"SQLite error during init: {e}")
+        LOG.error("SQLite error during init: %s", e)
         return None
 
 
-def insert_tracker_info(conn, data):
+def local_time_to_epoch_ms(value):
+    """
+    Convert a timestamp written by former versions to epoch milliseconds.
+
+    Args:
+        value (str): Local time in LEGACY_TIME_FORMAT and LEGACY_TIME_ZONE.
+
+    Returns:
+        int: Epoch milliseconds or the unchanged value if it is no legacy timestamp.
+    """
+    try:
+        local_dt = datetime.strptime(value, LEGACY_TIME_FORMAT).replace(tzinfo=LEGACY_TIME_ZONE)
+    except (TypeError, ValueError):
+        return value
+    return int(local_dt.timestamp()) * 1000
+
+
+def insert_tracker_info(conn, row):
+    """
+    Queue a row of tracker data for the 'tracker_data' table.
+
+    Rows are buffered and written in one transaction as soon as
+    BATCH_SIZE rows are pending or the last write is older than
+    FLUSH_INTERVAL seconds.
+
+    Args:
+        conn (sqlite3.Connection): An active SQLite connection.
+        row (tuple): Tracker values in the order of FIELDNAMES.
+
+    Returns:
+        bool: True if the buffered rows were written, False if no write was due
+        or it failed (see flush_tracker_info).
+    """
+
+    _buffer.append(row)
+
+    if len(_buffer) >= BATCH_SIZE or time.monotonic() - _last_flush > FLUSH_INTERVAL:
+        return flush_tracker_info(conn)
+
+    return False
+
+
+def flush_tracker_info(conn):
     """
-    Insert a row of tracker data into the 'tracker_data' table.
+    Write all buffered rows into the 'tracker_data' table in a single transaction.
+
+    Rows that can not be bound to the INSERT statement are dropped and logged,
+    the other rows of the batch are still written. On any other database error
+    (e.g. locked database, disk full) the batch is rolled back and kept in the
+    buffer, so the next flush retries it.
 
     Args:
         conn (sqlite3.Connection): An active SQLite connection.
-        data (dict): A dictionary containing tracker info with keys:
-            'tracker_id', 'latitude', 'longitude', 'battery',
-            'timestamp', 'gw-rssi', 'gw-name', 'gw-latitude', 'gw-longitude', 'gw-timestamp'
+
+    Returns:
+        bool: True if the buffer was written, False if it is kept for a retry.
     """
+    global _last_flush  # pylint: disable=global-statement
+
+    _last_flush = time.monotonic()
+    if not _buffer:
+        return True
 
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO tracker_data (
-                tracker_id, latitude, longitude, battery, timestamp,
-                gw_rssi, gw_name, gw_latitude, gw_longitude, gw_timestamp
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data["tracker_id"],
-            data["latitude"],
-            data["longitude"],
-            data["battery"],
-            data["timestamp"],
-            data["gw-rssi"],
-            data["gw-name"],
-            data["gw-latitude"],
-            data["gw-longitude"],
-            data["gw-timestamp"]
-        ))
-        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("SAVEPOINT batch")
+        try:
+            conn.executemany(INSERT_SQL, _buffer)
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError):
+            # At least one row has invalid values, insert row by row to drop only those
+            conn.execute("ROLLBACK TO batch")
+            for row in _buffer:
+                try:
+                    conn.execute(INSERT_SQL, row)
+                except (sqlite3.InterfaceError, sqlite3.ProgrammingError) as e:
+                    LOG.error("Invalid tracker row dropped: %s (%s)", row, e)
+        conn.execute("COMMIT")
     except sqlite3.Error as e:
-        print(f"SQLite error during insert: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        LOG.error("SQLite error during insert, %d rows kept for retry: %s", len(_buffer), e)
+        return False
+
+    _buffer.clear()
+    return True
@@ -11,18 +11,28 @@ This modul handle the mqtt connection and uses submodules for database handling
 # Imports **********************************************************************
 
 import sys
+import atexit
 import logging
 import os
+import re
+import queue
+import threading
 import argparse
-import json
+import signal
 import ssl
 import csv
-from zoneinfo import ZoneInfo
+import sqlite3
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
 import trackingmap_agent.tracker_db
 
+try:
+    # orjson is optional, it parses the uplink payloads considerably faster
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 try:
     from trackingmap_agent.version import __version__, __author__, __email__, __repository__, __license__
 except ModuleNotFoundError:
@@ -38,11 +48,94 @@ except ModuleNotFoundError:
 
 LOG: logging.Logger = logging.getLogger(__name__)
 
+# Positions in a tracker row, see trackingmap_agent.tracker_db.FIELDNAMES
+_LATITUDE, _LONGITUDE, _BATTERY, _TIMESTAMP = 1, 2, 3, 4
+
+# Positions in a tracker row by CSV value type
+_TEXT_FIELDS = (0, 6, 9)
+_INT_FIELDS = (3, 4, 5)
+_FLOAT_FIELDS = (1, 2, 7, 8)
+
+# Characters that require CSV quoting
+_CSV_SPECIAL = re.compile(r'[,"\r\n]')
+
+# Tracker rows waiting for the writer thread, None stops the thread
+_write_q: queue.Queue = queue.Queue(maxsize=10000)
+
 # Classes **********************************************************************
 
+
+class SafeCSV:
+    """
+    CSV writer for tracker rows with the fixed layout of tracker_db.FIELDNAMES.
+
+    Rows are written with a precompiled format string in a single write call.
+    Rows with text that would need quoting, or with unexpected value types,
+    are passed to a regular csv.writer instead. Coordinates are written
+    with 6 decimals in both cases.
+
+    Args:
+        file: Text file opened with newline=''
+    """
+
+    FMT = "{},{:.6f},{:.6f},{},{},{},{},{:.6f},{:.6f},{}\r\n"
+
+    def __init__(self, file):
+        self.file = file
+        self._writer = csv.writer(file)
+
+    def writerow(self, row):
+        """
+        Write one tracker row.
+
+        Args:
+            row (tuple): Tracker values in the order of tracker_db.FIELDNAMES
+        """
+        if self._is_plain(row):
+            self.file.write(self.FMT.format(*row))
+        else:
+            self._writer.writerow([f"{value:.6f}" if i in _FLOAT_FIELDS and isinstance(value, (int, float))
+                                   else value for i, value in enumerate(row)])
+
+    @staticmethod
+    def _is_plain(row):
+        """Check if all values fit FMT without any CSV quoting."""
+        return (all(isinstance(row[i], int) for i in _INT_FIELDS)
+                and all(isinstance(row[i], (int, float)) for i in _FLOAT_FIELDS)
+                and all(isinstance(row[i], str) and not _CSV_SPECIAL.search(row[i]) for i in _TEXT_FIELDS))
+
+    def flush(self):
+        """Write buffered rows to the file and sync it to disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
 # Functions ********************************************************************
 
 
+def _set_lon_and_ts(row, measurement):
+    """Take over longitude and measurement time (epoch milliseconds) from a position measurement."""
+    row[_LONGITUDE] = float(measurement["measurementValue"])
+    row[_TIMESTAMP] = int(measurement["timestamp"])
+
+
+def _set_lat(row, measurement):
+    """Take over latitude from a position measurement."""
+    row[_LATITUDE] = float(measurement["measurementValue"])
+
+
+def _set_battery(row, measurement):
+    """Take over the battery level in percent."""
+    row[_BATTERY] = int(measurement["measurementValue"])
+
+
+# Measurement handlers by measurementId
+HANDLERS = {
+    "4197": _set_lon_and_ts,
+    "4198": _set_lat,
+    "3000": _set_battery
+}
+
+
 def on_connect(cl, userdata, flags, rc, _):
     """
     Callback function triggered upon successful connection to the MQTT broker.
@@ -67,7 +160,7 @@ def on_connect(cl, userdata, flags, rc, _):
 def on_message(cl, userdata, msg):
     """
     Callback function triggered when a message is received on a subscribed topic.
-    Parses the JSON payload and prints device ID and decoded payload.
+    Parses the payload and queues the tracker row for the writer thread.
 
     Args:
         cl: The MQTT client instance.
@@ -75,85 +168,197 @@ def on_message(cl, userdata, msg):
         msg: The received MQTT message object.
     """
 
-    tracker_info = {
-        "tracker_id": "",
-        "latitude": 0.0,
-        "longitude": 0.0,
-        "battery": 0,  # Percenct
-        "timestamp": "",
-        "gw-rssi": -70,    # Signalstrength in dBm
-        "gw-name": "",
-        "gw-latitude": 0.0,
-        "gw-longitude": 0.0,
-        "gw-timestamp": ""
+    row = parse_message(msg.payload)
+    if row:
+        try:
+            _write_q.put_nowait(row)
+        except queue.Full:
+            LOG.warning("Write queue full, update for %s dropped", row[0])
+
+
+def parse_message(payload):
+    """
+    Parse a TTN uplink message into a tracker row.
 
+    Args:
+        payload (bytes): The raw JSON payload of the MQTT message.
 
-    }
+    Returns:
+        tuple: Tracker values in the order of tracker_db.FIELDNAMES or None,
+        if the message is invalid or contains no position.
+    """
 
+    LOG.debug("Payload: %s", payload)
     try:
-        LOG.debug("Payload: %s", msg.payload)
-        data = json.loads(msg.payload)
-    except (json.JSONDecodeError) as e:
+        data = _json.loads(payload)
+    except ValueError as e:     # JSONDecodeError, UnicodeDecodeError
         LOG.error("Json Decoding error: %s", e)
+        return None
 
+    dev = None
     try:
         dev = data["end_device_ids"]["device_id"]
-    except (KeyError) as e:
-        LOG.error("Error in message processing: %s for device id", e)
-        LOG.debug("Payload Data: %s", data)
-
-    try:
-        payl = data["uplink_message"]["decoded_payload"]["messages"][0]
-        rx_metadata = data["uplink_message"]["rx_metadata"][0]
+        uplink = data["uplink_message"]
+        payl = uplink["decoded_payload"]["messages"][0]
+        rx_metadata = uplink["rx_metadata"][0]
+        location = rx_metadata["location"]
         LOG.debug("Device: [%s] %s", dev, payl)
         LOG.debug("Metadata: %s", rx_metadata)
 
-        tracker_info["tracker_id"] = dev
-        tracker_info["gw-name"] = rx_metadata["gateway_ids"]["gateway_id"]
-        tracker_info["gw-rssi"] = rx_metadata["rssi"]
-        tracker_info["gw-latitude"] = rx_metadata["location"]["latitude"]
-        tracker_info["gw-longitude"] = rx_metadata["location"]["longitude"]
-        timestamp_str = rx_metadata["time"]
-        tracker_info["gw-timestamp"] = (datetime.fromisoformat(timestamp_str.replace("Z",
-                                        "+00:00")) + timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")
+        gw_timestamp = (datetime.fromisoformat(rx_metadata["time"].replace("Z",
+                        "+00:00")) + timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")
+
+        # Same column order as trackingmap_agent.tracker_db.FIELDNAMES
+        row = [
+            dev,
+            0.0,    # latitude
+            0.0,    # longitude
+            0,      # battery in percent
+            0,      # timestamp in epoch milliseconds
+            int(rx_metadata["rssi"]),   # signal strength in dBm
+            rx_metadata["gateway_ids"]["gateway_id"],
+            float(location["latitude"]),
+            float(location["longitude"]),
+            gw_timestamp
+        ]
 
         for measurement in payl:
-            if measurement["measurementId"] == "4197":
-                tracker_info["longitude"] = measurement["measurementValue"]
-                utc_dt = datetime.fromtimestamp(
-                    int(measurement["timestamp"])/1000, tz=ZoneInfo("Europe/Berlin"))
-                tracker_info["timestamp"] = utc_dt.strftime('%Y-%m-%d %H:%M:%S')
-            if measurement["measurementId"] == "4198":
-                tracker_info["latitude"] = measurement["measurementValue"]
-            if measurement["measurementId"] == "3000":
-                tracker_info["battery"] = measurement["measurementValue"]
-        LOG.info("Update for %s at %s",
-                 tracker_info["tracker_id"], tracker_info["timestamp"])
-        if tracker_info["latitude"] != 0.0 and tracker_info["longitude"] != 0.0:
-            trackingmap_agent.tracker_db.insert_tracker_info(db_conn, tracker_info)
-            csv_writer.writerow(tracker_info)
-    except (KeyError) as e:
+            handler = HANDLERS.get(measurement["measurementId"])
+            if handler:
+                handler(row, measurement)
+        # Local measurement time for the log, also rejects timestamps out of range
+        update_time = datetime.fromtimestamp(row[_TIMESTAMP] / 1000).strftime("%Y-%m-%d %H:%M:%S")
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError, OSError) as e:
         LOG.error("Error in message processing: %s for device: %s", e, dev)
         LOG.debug("Payload Data: %s", data)
+        return None
+
+    if row[_LATITUDE] == 0.0 or row[_LONGITUDE] == 0.0:
+        LOG.info("Update for %s without position", dev)
+        return None
+
+    LOG.info("Update for %s at %s", dev, update_time)
+
+    return tuple(row)
+
+
+def _writer_loop(db_conn):
+    """
+    Write queued tracker rows to the database and the CSV file.
+
+    Runs in its own thread that takes over the database connection, so disk
+    latency does not block the MQTT network thread. Pending rows are
+    flushed whenever the queue stays empty for FLUSH_INTERVAL seconds.
+    The CSV file is synced together with each database batch.
+
+    Args:
+        db_conn (sqlite3.Connection): Database connection, closed when the loop ends.
+    """
+    pending = False
+    while True:
+        try:
+            row = _write_q.get(timeout=trackingmap_agent.tracker_db.FLUSH_INTERVAL)
+        except queue.Empty:
+            if pending:
+                pending = not _flush_writer(db_conn)
+            continue
+
+        if row is None:
+            _flush_writer(db_conn)
+            db_conn.close()
+            return
+
+        try:
+            csv_writer.writerow(row)
+            pending = True
+            if trackingmap_agent.tracker_db.insert_tracker_info(db_conn, row):
+                csv_writer.flush()
+                pending = False
+        except (OSError, sqlite3.Error) as e:
+            LOG.error("Storing update for %s failed: %s", row[0], e)
+
+
+def _flush_writer(db_conn):
+    """
+    Write the buffered rows to the database and sync the CSV file.
+
+    Args:
+        db_conn (sqlite3.Connection): Connection of the writer thread.
+
+    Returns:
+        bool: True if the data was stored, False on error.
+    """
+    try:
+        stored = trackingmap_agent.tracker_db.flush_tracker_info(db_conn)
+        csv_writer.flush()
+        return stored
+    except (OSError, sqlite3.Error) as e:
+        LOG.error("Storing tracker data failed: %s", e)
+        return False
+
+
+def _stop_writer(writer_thread):
+    """Let the writer thread store all queued rows and wait for it to finish."""
+    if writer_thread.is_alive():
+        _write_q.put(None)
+        writer_thread.join(timeout=5.0)
+
+
+def _on_sigterm(signum, _):
+    """Exit normally on SIGTERM, so the atexit handlers store all queued rows."""
+    LOG.info("Terminated by signal %s", signum)
+    sys.exit(0)
+
+
+def _migrate_csv(file_path, fieldnames):
+    """
+    Rewrite a CSV file of a former version with the current header and
+    timestamps in epoch milliseconds.
+
+    Args:
+        file_path (str): File name and path
+        fieldnames (tuple): Current column names
+    """
+    LOG.info("Migrating %s to the current format", file_path)
+    tmp_path = file_path + ".tmp"
+    with open(file_path, newline='', encoding='utf-8') as src, \
+            open(tmp_path, mode='w', newline='', encoding='utf-8') as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst)
+        next(reader)
+        writer.writerow(fieldnames)
+        for row in reader:
+            if len(row) > _TIMESTAMP:
+                row[_TIMESTAMP] = trackingmap_agent.tracker_db.local_time_to_epoch_ms(row[_TIMESTAMP])
+            writer.writerow(row)
+    os.replace(tmp_path, file_path)
 
 
 def init_csv_writer(file_path, fieldnames):
     """
     Initialize CSV output of received tracker data
 
+    A file with a different header was written by a former version
+    and gets migrated first.
+
     Args:
         file_path (str): File name and path
-        fieldnames (dict): Dictionary with field names
+        fieldnames (tuple): Column names, written as header of a new file
 
     Returns:
-        handle: Handler to writer object
+        SafeCSV: Handler to writer object
     """
     file_exists = os.path.isfile(file_path)
-    file = open(file_path, mode='a', newline='', encoding='utf-8', buffering=1)
-    writer = csv.DictWriter(file, fieldnames=fieldnames)
+    if file_exists:
+        with open(file_path, newline='', encoding='utf-8') as file:
+            header = next(csv.reader(file), None)
+        if header is not None and header != list(fieldnames):
+            _migrate_csv(file_path, fieldnames)
+    file = open(file_path, mode='a', newline='', encoding='utf-8', buffering=65536)
+    writer = SafeCSV(file)
 
     if not file_exists:
-        writer.writeheader()
+        csv.writer(file).writerow(fieldnames)
 
     return writer
 
@@ -191,6 +396,17 @@ def main() -> int:
     LOG.debug("Client ID: %s", CLIENT_ID)
     LOG.debug("Credentials: %s - %s", USERNAME, PASSWORD)
 
+    db_conn = trackingmap_agent.tracker_db.init_db()
+    if db_conn is None:
+        LOG.error("Database not available, exiting")
+        return 1
+
+    writer_thread = threading.Thread(target=_writer_loop, args=(db_conn,), name="tracker-writer", daemon=True)
+    writer_thread.start()
+    # write rows still queued when the agent stops
+    atexit.register(_stop_writer, writer_thread)
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
                          CLIENT_ID, protocol=mqtt.MQTTv311)
     client.username_pw_set(USERNAME, PASSWORD)
@@ -224,23 +440,7 @@ USERNAME = app_id
 PASSWORD = api_key
 TOPIC = "v3/+/devices/+/up"    # all uplinks of all devices
 
-# For CSV File init only
-tracker_info = {
-    "tracker_id": "",
-    "latitude": 0.0,
-    "longitude": 0.0,
-    "battery": 0,
-    "timestamp": "",
-    "gw-rssi": -1,
-    "gw-name": "",
-    "gw-latitude": 0.0,
-    "gw-longitude": 0.0,
-    "gw-timestamp": ""
-}
-
-csv_writer = init_csv_writer("./tracker_data.csv", tracker_info.keys())
-
-db_conn = trackingmap_agent.tracker_db.init_db()
+csv_writer = init_csv_writer("./tracker_data.csv", trackingmap_agent.tracker_db.FIELDNAMES)
 
 if __name__ == "__main__":
     sys.exit(main())
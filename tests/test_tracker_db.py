@@ -0,0 +1,118 @@
+"""Tests for the tracker database handler
+"""
+
+from trackingmap_agent import tracker_db
+
+
+def test_init_db_sets_journal_mode(tmp_path):
+    """A file based database is switched to the configured journal mode.
+    """
+    conn = tracker_db.init_db(str(tmp_path / "tracker_data.db"))
+
+    mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == tracker_db.JOURNAL_MODE.lower()
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert conn.execute("PRAGMA page_size").fetchone()[0] == tracker_db.PAGE_SIZE
+    conn.close()
+
+
+def test_init_db_in_memory():
+    """An in-memory database keeps its journal mode but gets the schema.
+    """
+    conn = tracker_db.init_db(":memory:")
+
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert {"tracker_data", "tracker_config"} <= tables
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "memory"
+    conn.close()
+
+
+def _tracker_row(tracker_id="tracker-1"):
+    return (tracker_id, 48.1, 11.5, 80, 1735732800000,
+            -70, "gw-1", 48.0, 11.4, "2025-01-01 12:00:01")
+
+
+def test_insert_is_buffered_until_flush(monkeypatch):
+    """Rows are only written when the buffer gets flushed.
+    """
+    monkeypatch.setattr(tracker_db, "FLUSH_INTERVAL", 3600.0)
+    conn = tracker_db.init_db(":memory:")
+    tracker_db.flush_tracker_info(conn)
+
+    tracker_db.insert_tracker_info(conn, _tracker_row())
+    assert conn.execute("SELECT COUNT(*) FROM tracker_data").fetchone()[0] == 0
+
+    tracker_db.flush_tracker_info(conn)
+    assert conn.execute("SELECT tracker_id FROM tracker_data").fetchall() == [("tracker-1",)]
+    conn.close()
+
+
+def test_insert_flushes_full_batch(monkeypatch):
+    """A full batch is written without an explicit flush.
+    """
+    monkeypatch.setattr(tracker_db, "FLUSH_INTERVAL", 3600.0)
+    monkeypatch.setattr(tracker_db, "BATCH_SIZE", 3)
+    conn = tracker_db.init_db(":memory:")
+    tracker_db.flush_tracker_info(conn)
+
+    written = [tracker_db.insert_tracker_info(conn, _tracker_row(f"tracker-{i}")) for i in range(3)]
+
+    assert written == [False, False, True]
+
+    assert conn.execute("SELECT COUNT(*) FROM tracker_data").fetchone()[0] == 3
+    conn.close()
+
+
+def test_init_db_migrates_legacy_timestamps(tmp_path):
+    """Formatted Europe/Berlin timestamps of former versions are converted to epoch ms once.
+    """
+    db_path = str(tmp_path / "tracker_data.db")
+    conn = tracker_db.init_db(db_path)
+    conn.execute("PRAGMA user_version=0")
+    conn.execute("INSERT INTO tracker_data (tracker_id, timestamp) VALUES ('old', '2025-01-01 13:00:00')")
+    conn.execute("INSERT INTO tracker_data (tracker_id, timestamp) VALUES ('new', 1735732860000)")
+    conn.close()
+
+    for _ in range(2):
+        conn = tracker_db.init_db(db_path)
+        rows = conn.execute("SELECT tracker_id, timestamp FROM tracker_data ORDER BY timestamp DESC").fetchall()
+        assert rows == [("new", 1735732860000), ("old", 1735732800000)]
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == tracker_db.SCHEMA_VERSION
+        conn.close()
+
+
+def test_flush_drops_only_invalid_rows(monkeypatch):
+    """A row that can not be bound is dropped, the rest of the batch is written.
+    """
+    monkeypatch.setattr(tracker_db, "FLUSH_INTERVAL", 3600.0)
+    conn = tracker_db.init_db(":memory:")
+    tracker_db.flush_tracker_info(conn)
+
+    for i in range(5):
+        tracker_db.insert_tracker_info(conn, _tracker_row(f"tracker-{i}"))
+    tracker_db.insert_tracker_info(conn, ("bad", 48.1, {"value": 11.5}) + _tracker_row()[3:])
+
+    assert tracker_db.flush_tracker_info(conn)
+    assert conn.execute("SELECT COUNT(*) FROM tracker_data").fetchone()[0] == 5
+    conn.close()
+
+
+def test_flush_keeps_rows_on_database_error(monkeypatch, tmp_path):
+    """A batch that can not be written because the database is locked is retried later.
+    """
+    monkeypatch.setattr(tracker_db, "FLUSH_INTERVAL", 3600.0)
+    db_path = str(tmp_path / "tracker_data.db")
+    conn = tracker_db.init_db(db_path)
+    conn.execute("PRAGMA busy_timeout=0")
+    tracker_db.flush_tracker_info(conn)
+    tracker_db.insert_tracker_info(conn, _tracker_row())
+
+    other = tracker_db.init_db(db_path)
+    other.execute("BEGIN IMMEDIATE")
+    assert not tracker_db.flush_tracker_info(conn)
+    other.execute("ROLLBACK")
+    other.close()
+
+    assert tracker_db.flush_tracker_info(conn)
+    assert conn.execute("SELECT COUNT(*) FROM tracker_data").fetchone()[0] == 1
+    conn.close()
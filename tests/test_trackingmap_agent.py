@@ -0,0 +1,135 @@
+"""Tests for the MQTT agent
+"""
+
+import csv
+import importlib
+import io
+import json
+
+import pytest
+
+# Import the package before changing the directory, its version info is read relative to the repo root
+from trackingmap_agent import tracker_db
+
+pytest.importorskip("paho.mqtt.client")
+pytest.importorskip("dotenv")
+
+
+@pytest.fixture(name="agent", scope="module")
+def fixture_agent(tmp_path_factory):
+    """Import the agent module with test credentials in a temporary working directory.
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("TTN_APP_ID", "test-app")
+        mp.setenv("TTN_API_KEY", "test-key")
+        mp.chdir(tmp_path_factory.mktemp("agent"))
+        yield importlib.import_module("trackingmap_agent.trackingmap_agent")
+
+
+def _uplink(measurements, device_id="t1000"):
+    return json.dumps({
+        "end_device_ids": {"device_id": device_id},
+        "uplink_message": {
+            "decoded_payload": {"messages": [measurements]},
+            "rx_metadata": [{
+                "gateway_ids": {"gateway_id": "gw-1"},
+                "rssi": -90,
+                "location": {"latitude": 48.0, "longitude": 11.4},
+                "time": "2025-01-01T12:00:01.123Z"
+            }]
+        }
+    }).encode()
+
+
+POSITION = [
+    {"measurementId": "4197", "measurementValue": 11.5, "timestamp": 1735732800000},
+    {"measurementId": "4198", "measurementValue": 48.1, "timestamp": 1735732800000},
+    {"measurementId": "3000", "measurementValue": 80, "timestamp": 1735732800000}
+]
+
+
+def test_parse_message(agent):
+    """A valid uplink results in a row in the order of FIELDNAMES.
+    """
+    row = agent.parse_message(_uplink(POSITION))
+
+    assert row == ("t1000", 48.1, 11.5, 80, 1735732800000, -90, "gw-1", 48.0, 11.4, "2025-01-01 14:00:01")
+
+
+def test_parse_message_without_position(agent):
+    """An uplink without position measurements is not stored.
+    """
+    assert agent.parse_message(_uplink(POSITION[2:])) is None
+
+
+@pytest.mark.parametrize("payload", [
+    b"{bad",
+    b"\xff",
+    b"[1, 2]",
+    b'"text"',
+    b'{"end_device_ids": {}}',
+    b'{"end_device_ids": {"device_id": "t1000"}, "uplink_message": {}}',
+    _uplink([{"measurementId": "4197", "measurementValue": {"value": 11.5}, "timestamp": 1735732800000}]
+            + POSITION[1:]),
+    _uplink(POSITION[:2] + [{"measurementId": "3000", "measurementValue": [80], "timestamp": 1735732800000}]),
+    _uplink(POSITION[:2] + [{"measurementId": "3000", "measurementValue": "8,0", "timestamp": 1735732800000}]),
+    _uplink([{"measurementId": "4197", "measurementValue": 11.5, "timestamp": 10**20}] + POSITION[1:])
+])
+@pytest.mark.parametrize("json_module", ["default", "stdlib"])
+def test_parse_message_invalid(agent, monkeypatch, payload, json_module):
+    """Invalid payloads are skipped, also with the stdlib json fallback.
+    """
+    if json_module == "stdlib":
+        monkeypatch.setattr(agent, "_json", json)
+
+    assert agent.parse_message(payload) is None
+
+
+def _csv_lines(writer_class, rows):
+    file = io.StringIO(newline="")
+    writer = writer_class(file)
+    for row in rows:
+        writer.writerow(row)
+    return file.getvalue()
+
+
+def test_safecsv_matches_csv_writer(agent):
+    """The fast path writes the same lines as csv.writer with 6 decimal coordinates.
+    """
+    row = ("t1000", 48.1, 11.5, 80, 1735732800000, -90, "gw-1", 48.0, 11, "2025-01-01 14:00:01")
+    expected = ("t1000", "48.100000", "11.500000", 80, 1735732800000, -90, "gw-1",
+                "48.000000", "11.000000", "2025-01-01 14:00:01")
+
+    assert _csv_lines(agent.SafeCSV, [row]) == _csv_lines(csv.writer, [expected])
+
+
+@pytest.mark.parametrize("row", [
+    ("t1000", 48.1, 11.5, 80, 1735732800000, -90, "gw,1", 48.0, 11.4, "2025-01-01 14:00:01"),
+    ('t"1000', 48.1, 11.5, 80, 1735732800000, -90, "gw-1", 48.0, 11.4, "2025-01-01 14:00:01"),
+    ("t1000", 48.1, 11.5, "8,0", 1735732800000, -90, "gw-1", 48.0, 11.4, "2025-01-01 14:00:01"),
+    ("t1000", 48.1, 11.5, 80, 1735732800000, "-9\n0", "gw-1", 48.0, 11.4, "2025-01-01 14:00:01")
+])
+def test_safecsv_quoting_fallback(agent, row):
+    """Values that need quoting are written by csv.writer and read back unchanged.
+    """
+    read_back = next(csv.reader(io.StringIO(_csv_lines(agent.SafeCSV, [row]), newline="")))
+
+    assert read_back == [f"{value:.6f}" if isinstance(value, float) else str(value) for value in row]
+
+
+def test_init_csv_writer_migrates_legacy_file(agent, tmp_path):
+    """A CSV file of a former version gets the current header and epoch ms timestamps.
+    """
+    file_path = tmp_path / "tracker_data.csv"
+    file_path.write_bytes(
+        b"tracker_id,latitude,longitude,battery,timestamp,gw-rssi,gw-name,gw-latitude,gw-longitude,gw-timestamp\r\n"
+        b"t1000,48.1,11.5,80,2025-01-01 13:00:00,-90,gw-1,48.0,11.4,2025-01-01 14:00:01\r\n"
+        b"t1000,48.1,11.5,80,1735732860000,-90,gw-1,48.0,11.4,2025-01-01 14:01:01\r\n")
+
+    writer = agent.init_csv_writer(str(file_path), tracker_db.FIELDNAMES)
+    writer.file.close()
+
+    with open(file_path, newline="", encoding="utf-8") as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == list(tracker_db.FIELDNAMES)
+    assert [row[4] for row in rows[1:]] == ["1735732800000", "1735732860000"]